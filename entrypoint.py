@@ -4,17 +4,58 @@
 # with changed dependencies, then return as a JSON list
 
 import argparse
+import functools
 import json
 import logging
 import os
+import re
+import subprocess
 import yaml
-import logging
 
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from git import Repo
 from pathlib import Path
 import fnmatch
 
+# Use the libyaml C loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Directories which never contain nf-tests of interest: git internals, Nextflow work dirs and nf-test output
+SKIPPED_DIRS = frozenset({".git", ".nf-test", "work"})
+# Matches the component under test in a nf-test file, e.g. `process "PROCESS_A"`
+TEST_TYPE_RE = re.compile(
+    r"""^\s*(workflow|process|function)\s+["']?([^\s"'{]+)["']?\s*$"""
+)
+# Matches a `run("NAME")` statement in a nf-test file, including `run("NAME", alias: "X")`
+RUN_RE = re.compile(r"""^\s*run\(\s*["']([^"']+)["']""")
+# Matches the first component imported by an `include { NAME } from '...'` statement
+INCLUDE_RE = re.compile(r"""^\s*include\s*\{\s*([^\s;}]+)""")
+
+
+@functools.cache
+def _read_lines(path: Path) -> tuple[str, ...]:
+    return tuple(path.read_text().splitlines())
+
+
+def read_lines(path: Path) -> list[str]:
+    """
+    Read a file and return its lines, opening each file at most once per run.
+
+    Several nf-tests usually share one Nextflow script (e.g. `main.nf`), so the
+    lines are cached by resolved path.
+
+    Args:
+        path (Path): The path to the file.
+
+    Returns:
+        list[str]: The lines of the file.
+    """
+    return list(_read_lines(Path(path).resolve()))
+
 
 class TestTargetType(Enum):
     """
@@ -34,14 +75,17 @@ class NextflowFile:
     Attributes:
         path (str): The path to the Nextflow file.
         lines (list[str]): The lines of the Nextflow file.
-        includes (list[str]): A list of imported Nextflow workflows, processes or functions
+        includes (set[str]): A set of imported Nextflow workflows, processes or functions
     """
 
     def __init__(self, path):
         self.path = path
-        self.lines = self.read_nf_file()
         self.includes = self.find_include_statements()
 
+    @functools.cached_property
+    def lines(self) -> list[str]:
+        return self.read_nf_file()
+
     def read_nf_file(self) -> list[str]:
         """
         Read the Nextflow file and return its lines as a list.
@@ -49,22 +93,20 @@ class NextflowFile:
         Returns:
             list[str]: The lines of the Nextflow file.
         """
-        with open(self.path, "r") as f:
-            return f.readlines()
+        return read_lines(self.path)
 
-    def find_include_statements(self) -> list[str]:
+    def find_include_statements(self) -> set[str]:
         """
         Find all include statements in the Nextflow file.
 
         Returns:
-            list[str]: The include statements found in the Nextflow file.
+            set[str]: The include statements found in the Nextflow file.
         """
-        result = []
-        for line in self.lines:
-            if "include {" in line:
-                dependency = line.split()[2].strip("'\"").replace("/", "_").casefold()
-                result.append(dependency)
-        return result
+        return set(
+            match.group(1).replace("/", "_").casefold()
+            for match in map(INCLUDE_RE.match, self.lines)
+            if match
+        )
 
 
 class NfTest:
@@ -77,12 +119,12 @@ class NfTest:
         lines (list[str]): The lines of the test file.
         test_type (TestTargetType): The type of the test.
         test_name (str): The name of the test.
-        run_statements (list[str]): The run statements in the test.
+        run_statements (set[str]): The run statements in the test.
         config_file (Path | None): The path to the configuration file, or None if it doesn't exist.
         nextflow_path (Path): The path to the Nextflow script.
         nextflow (NextflowFile): The NextflowFile object representing the Nextflow script.
         root_path (Path): The common path between the Nextflow script and the test file.
-        dependencies (list[str]): The dependencies of the test.
+        dependencies (set[str]): The dependencies of the test.
     """
 
     def __init__(self, path, repo: Path = Path(".")):
@@ -93,20 +135,22 @@ class NfTest:
     def __str__(self):
         return f"Test: {self.test_name}, Type: {self.test_type}, Path: {self.test_path}"
 
+    @functools.cached_property
+    def lines(self) -> list[str]:
+        return self.read_test_file(self.test_path)
+
     def read_test_file(self, readpath: Path) -> list[str]:
-        with open(readpath, "r") as f:
-            return f.readlines()
+        return read_lines(readpath)
 
     def populate_attributes(self):
         self.test_dir = self.test_path.parent
-        self.lines = self.read_test_file(self.test_path)
         self.test_type, self.test_name = self.find_test_type()
         self.run_statements = self.find_run_statements()
         self.config_files = self.find_config_lines()
         self.nextflow_path = self.find_script_line()
         self.nextflow = NextflowFile(self.nextflow_path)
         self.root_path = self.find_common_path()
-        self.dependencies = self.nextflow.includes + self.run_statements
+        self.dependencies = self.nextflow.includes | self.run_statements
 
     def find_script_line(self) -> Path:
         """
@@ -165,41 +209,24 @@ class NfTest:
 
         """
         for line in self.lines:
-            words = line.split()
-            if (
-                line.strip().startswith(("workflow", "process", "function"))
-                and len(words) == 2
-            ):
-                keyword = words[0]
-                name = words[1].strip("'\"")  # Strip both single and double quotes
+            if match := TEST_TYPE_RE.match(line):
+                keyword, name = match.groups()
                 return (TestTargetType(keyword), name)
         return (TestTargetType("pipeline"), "PIPELINE")
 
-    def find_run_statements(self) -> list[str]:
+    def find_run_statements(self) -> set[str]:
         """
         Find all run statements in a list of lines.
 
-        Args:
-            lines (list): List of lines to scan.
-
         Returns:
-            list: List of run statements.
+            set: Set of run statements.
         """
-        result = []
-        for line in self.lines:
-            if line.strip().startswith("run"):
-                # This parses `run("<tool>")` to `<tool>
-                dependency = (
-                    line.strip()
-                    .split()[0]
-                    .lstrip("run(")
-                    .rstrip(")")
-                    .strip("\"'")
-                    .casefold()
-                )
-                result.append(dependency)
-
-        return result
+        # This parses `run("<tool>")` to `<tool>`
+        return set(
+            match.group(1).casefold()
+            for match in map(RUN_RE.match, self.lines)
+            if match
+        )
 
     def find_common_path(self) -> Path:
         """
@@ -261,22 +288,6 @@ class NfTest:
             ]
         )
 
-    def find_matching_dependencies(self, other_nf_tests):
-        """
-        Finds and returns a list of NF tests from `other_nf_tests` that have matching test names in `self.dependencies`.
-
-        Args:
-            other_nf_tests (list): A list of NF tests to compare against.
-
-        Returns:
-            list: A list of NF tests that have matching test names in `self.dependencies`.
-        """
-        return [
-            nf_test
-            for nf_test in other_nf_tests
-            if nf_test.test_name.casefold() in self.dependencies
-        ]
-
     def get_parents(self, n: int) -> Path:
         """
         Get the parent directory of a path n levels up.
@@ -285,10 +296,26 @@ class NfTest:
         Returns:
             Path: The parent directory n levels up.
         """
-        _path = self.test_path
-        for _ in range(n):
-            _path = _path.parent
-        return _path
+        if n == 0:
+            return self.test_path
+        # Going past the top of the path stays at the top, as with repeated `.parent`
+        return self.test_path.parents[min(n, len(self.test_path.parents)) - 1]
+
+
+def non_negative_int(value: str) -> int:
+    """
+    Argparse type for integers which must be zero or greater.
+
+    Args:
+        value (str): The command line value.
+
+    Returns:
+        int: The parsed integer.
+    """
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater, got {number}")
+    return number
 
 
 def parse_args() -> argparse.Namespace:
@@ -361,7 +388,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "-n",
         "--n_parents",
-        type=int,
+        type=non_negative_int,
         default=0,
         help="Number of parents to up to return. 0 for file, 1 for immediate dir, 2 for parent dir, etc.",
     )
@@ -378,20 +405,37 @@ def read_yaml_inverted(file_path: str) -> dict:
     Returns:
         dict: The contents of the YAML file as a dictionary inverted.
     """
-    with open(file_path, "r") as f:
-        data = yaml.safe_load(f)
+    with open(file_path, "rb") as f:
+        data = yaml.load(f, Loader=SafeLoader)
 
     # Invert dictionary of lists into contents of lists are keys, values are the original keys
     # { "key": ["item1", "item2] } --> { "item1": "key", "item2": "key" }
     return {value: key for key, values in data.items() for value in values}
 
 
+def compile_globs(patterns: list[str]) -> re.Pattern:
+    """
+    Translate a list of glob patterns into a single compiled regular expression matching paths as bytes.
+
+    Args:
+        patterns (list[str]): The glob patterns, as understood by fnmatch.
+
+    Returns:
+        re.Pattern: A bytes pattern matching any path matched by one of the globs. Matches nothing if no globs are given.
+    """
+    if not patterns:
+        return re.compile(rb"(?!)")
+    return re.compile(
+        os.fsencode("|".join(fnmatch.translate(pattern) for pattern in patterns))
+    )
+
+
 def find_changed_files(
     path: Path,
     branch1: str,
     branch2: str,
-    ignore: list[str],
-) -> list[Path]:
+    ignore: re.Pattern,
+) -> set[Path]:
     """
     Find all *.nf.tests that are associated with files that have been changed between two specified branches.
 
@@ -399,77 +443,125 @@ def find_changed_files(
         repo (Path)        : Path to the repository to scan.
         branch1 (str)      : The first branch being compared
         branch2 (str)      : The second branch being compared
-        ignore  (list)     : List of files or file substrings to ignore.
+        ignore  (re.Pattern): Compiled bytes pattern of files or file substrings to ignore.
 
     Returns:
-        list: List of files matching the pattern *.nf.test that have changed between branch2 and branch1.
+        set: Set of files matching the pattern *.nf.test that have changed between branch2 and branch1.
     """
 
-    # Initialise repo for scanning
-    repo = Repo(path)
-
-    # identify commit on branch1
-    branch1_commit = repo.commit(branch1)
-    # identify commit on branch2
-    branch2_commit = repo.commit(branch2)
-    # compare two branches
-    diff_index = branch1_commit.diff(branch2_commit)
-
-    # Start empty list of changed files
-    changed_files = []
-
-    # For every file that has changed between commits
-    for file in diff_index:
-        # Get pathlib.Path object
-        filepath = Path(file.a_path)
-        logging.debug(f"File found in diff_index: {str(filepath)}")
-
-        # If file does not match any in the ignore list, add containing directory to changed_files
-        match_against_ignored = []
-        for ignored_path in ignore:
-            is_matched = fnmatch.fnmatch(str(filepath), ignored_path)
-            logging.debug(
-                f"Checking match of {str(filepath)} against {str(ignored_path)}: {str(is_matched)}"
-            )
-            match_against_ignored.append(is_matched)
-        if not any(match_against_ignored):
+    # Compare the two branches with a single git call, listing only the changed paths
+    diff = subprocess.run(
+        [
+            "git",
+            "-C",
+            str(path),
+            "diff",
+            "-z",
+            "--name-only",
+            "--no-renames",
+            # Refs are never read as options or paths, even if a file shares their name
+            "--end-of-options",
+            branch1,
+            branch2,
+            "--",
+        ],
+        # Only stdout is captured, so git's own error message reaches the log
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+
+    # Start empty set of changed files
+    changed_files = set()
+
+    # For every file that has changed between commits. Paths are NUL separated and
+    # left as bytes, so only the files which are not ignored get decoded
+    for raw_path in diff.stdout.split(b"\0"):
+        # If file does not match the ignore pattern, add containing directory to changed_files
+        if raw_path and not ignore.match(raw_path):
             # Prepend the root of the path for better scanning
-            changed_files.append(path.joinpath(filepath).resolve())
+            changed_files.add(path.joinpath(os.fsdecode(raw_path)).resolve())
 
-    # Uniqueify the results before returning for efficiency
-    return list(set(changed_files))
+    return changed_files
 
 
 def detect_include_files(
-    changed_files: list[Path], include_files: dict[str, str], root: Path
-) -> list[Path]:
+    changed_files: set[Path], include_files: dict[str, str], root: Path
+) -> set[Path]:
     """
     Detects the include files based on the changed files.
 
     Args:
-        changed_files (list[Path]): List of paths to the changed files.
+        changed_files (set[Path]): Set of paths to the changed files.
         include_files (dict[str, str]): Key-value pairs to return if a certain file has changed. If a file in a directory has changed, it points to a different directory.
         root (Path): The root path of the repository.
 
     Returns:
-        list[Path]: List of paths to representing the keys of the include_files dictionary, where a value matched a path in changed_files.
+        set[Path]: Set of paths to representing the keys of the include_files dictionary, where a value matched a path in changed_files.
     """
-    new_changed_files = []
+    # Group the globs by the key they point at, so each file is added once per key
+    include_globs: dict[str, list[str]] = {}
+    for include_path, include_key in include_files.items():
+        include_globs.setdefault(include_key, []).append(include_path)
+
+    new_changed_files = set()
     for filepath in changed_files:
         # If file is in the include_files, we return the key instead of the value
-        for include_path, include_key in include_files.items():
-            if filepath.match(include_path):
-                new_changed_files.append(root.joinpath(Path(include_key)).resolve())
+        for include_key, include_paths in include_globs.items():
+            if any(filepath.match(include_path) for include_path in include_paths):
+                new_changed_files.add(root.joinpath(Path(include_key)).resolve())
     return new_changed_files
 
 
+def index_dependencies(nf_tests: list[NfTest]) -> dict[str, list[NfTest]]:
+    """
+    Builds a reverse index from each dependency name to the NF tests depending on it.
+
+    Args:
+        nf_tests (list[NfTest]): The NF tests to index.
+
+    Returns:
+        dict[str, list[NfTest]]: Casefolded dependency names mapped to the NF tests which include or run them.
+    """
+    index: dict[str, list[NfTest]] = {}
+    for nf_test in nf_tests:
+        for dependency in nf_test.dependencies:
+            index.setdefault(dependency, []).append(nf_test)
+    return index
+
+
+def scan_files(root: Path, suffix: str) -> Iterator[Path]:
+    """
+    Recursively yields files under `root` whose name ends with `suffix`.
+
+    Walks the tree with os.scandir on plain strings, so no Path objects or extra
+    stat calls are made for files which do not match. Symlinked directories are
+    not followed and directories in SKIPPED_DIRS are not descended into.
+
+    Args:
+        root (Path): The directory to scan.
+        suffix (str): File suffix to detect, e.g. ".nf.test".
+
+    Yields:
+        Path: Paths to the matching files.
+    """
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SKIPPED_DIRS:
+                        stack.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    yield Path(entry.path)
+
+
 def detect_files(paths: list[Path], suffix: str) -> list[Path]:
     """
     Detects and returns a list of nf-test files from the given list of changed files.
 
     Args:
         paths (list[Path]): A list of file paths to scan.
-        suffix (str): File suffix to detect
+        suffix (str): File suffix to detect, e.g. ".nf.test".
 
     Returns:
         list[Path]: A list of nf-test file paths.
@@ -478,7 +570,7 @@ def detect_files(paths: list[Path], suffix: str) -> list[Path]:
 
     for path in paths:
         # If Path is the exact nf-test file add to list:
-        if path.match(suffix) and path.exists():
+        if path.name.endswith(suffix) and path.exists():
             result.append(path)
         # Else recursively search for nf-test files:
         elif path.is_dir():
@@ -487,16 +579,14 @@ def detect_files(paths: list[Path], suffix: str) -> list[Path]:
             # dir/
             # ├─ main.nf
             # ├─ main.nf.test
-            for file in path.rglob(suffix):
-                result.append(file)
+            result.extend(scan_files(path, suffix))
         elif path.is_file():
             # Search the enclosing dir so files in the same dir can be found.
             # e.g.
             # dir/
             # ├─ main.nf
             # ├─ main.nf.test
-            for file in path.parent.rglob(suffix):
-                result.append(file)
+            result.extend(scan_files(path.parent, suffix))
 
     return result
 
@@ -507,14 +597,11 @@ if __name__ == "__main__":
     args = parse_args()
     logging.basicConfig(level=args.log_level)
     # Argparse handling of nargs is a bit rubbish. So we do it manually here.
-    args.types = args.types.split(",")
+    args.types = frozenset(args.types.split(","))
     # Quick validation of args.types since we cant do this in argparse
-    if any(
-        _type not in ["function", "process", "workflow", "pipeline"]
-        for _type in args.types
-    ):
+    if not args.types <= {_type.value for _type in TestTargetType}:
         raise ValueError(
-            f"Invalid test type specified. Must be one of 'function', 'process', 'workflow', 'pipeline'. Found: {args.types}"
+            f"Invalid test type specified. Must be one of 'function', 'process', 'workflow', 'pipeline'. Found: {sorted(args.types)}"
         )
 
     root_path = Path(args.path)
@@ -526,7 +613,7 @@ if __name__ == "__main__":
         f"Getting files that are different between {args.head_ref} and {args.base_ref}"
     )
     changed_files = find_changed_files(
-        root_path, args.head_ref, args.base_ref, args.ignored_files
+        root_path, args.head_ref, args.base_ref, compile_globs(args.ignored_files)
     )
     logging.debug(f"Found changed files:{changed_files}")
 
@@ -535,15 +622,17 @@ if __name__ == "__main__":
         logging.debug(f"Reading include file: {args.include}")
         include_files = read_yaml_inverted(args.include)
         logging.info(f"Supplementing changed files with include files: {include_files}")
-        changed_files = changed_files + detect_include_files(
-            changed_files, include_files, root_path
-        )
+        changed_files |= detect_include_files(changed_files, include_files, root_path)
 
     logging.info("Parsing nf-test files...")
-    nf_test_objects = [
-        NfTest(_nf_test_file, repo=root_path)
-        for _nf_test_file in detect_files([root_path], "*.nf.test")
-    ]
+    # Parsing is dominated by file reads, so spread it over a pool of threads
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        nf_test_objects = list(
+            executor.map(
+                functools.partial(NfTest, repo=root_path),
+                detect_files([root_path], ".nf.test"),
+            )
+        )
     logging.debug(f"Found nf-test files: {[str(x.test_path) for x in nf_test_objects]}")
 
     logging.info(
@@ -552,59 +641,63 @@ if __name__ == "__main__":
     # Get intersect of changed files and Nextflow components with nf-test files
     logging.info("Finding Nextflow components which have been modified...")
     # changed_files = [changed_files[1]]  # sneaky debugging thing do not merge
-    directly_modified_nf_tests = [
+    directly_modified_nf_tests = {
         nf_test_object
         for changed_file in changed_files
         for nf_test_object in nf_test_objects
         if nf_test_object.detect_if_path_is_in_test(changed_file)
-    ]
+    }
     logging.debug(
         f"nf-tests with directly modified nf-test scripts, nextflow scripts, or config files: {[str(x.test_path) for x in directly_modified_nf_tests]}"
     )
 
     # Get all tests whose dependencies have changed
     logging.info("Finding Nextflow components whose dependencies have changed...")
-    indirectly_modified_nf_tests = [
+    directly_modified_test_names = {
+        nf_test.test_name.casefold() for nf_test in directly_modified_nf_tests
+    }
+    # Only tests of the selected types are returned, so only those need indexing
+    dependency_index = index_dependencies(
+        [
+            nf_test
+            for nf_test in nf_test_objects
+            if nf_test.test_type.value in args.types
+        ]
+    )
+    indirectly_modified_nf_tests = {
         _nf_test_obj
-        for _nf_test_obj in nf_test_objects
-        if _nf_test_obj.find_matching_dependencies(directly_modified_nf_tests) != []
-    ]
+        for test_name in directly_modified_test_names
+        for _nf_test_obj in dependency_index.get(test_name, [])
+    }
     logging.debug(
         f"Indirectly modified nf-tests: {[str(x.test_path) for x in indirectly_modified_nf_tests]}"
     )
 
     # Get union of all test files
     logging.debug("Getting union of all nf-test files...")
-    all_nf_tests = list(
-        {
-            nf_test
-            for nf_test in directly_modified_nf_tests + indirectly_modified_nf_tests
-        }
-    )
+    all_nf_tests = directly_modified_nf_tests | indirectly_modified_nf_tests
 
     # Filter down to only relevant tests
     logging.debug(f"Filtering down to only relevant test types: {args.types}")
-    only_selected_nf_tests = [
+    only_selected_nf_tests = {
         nf_test for nf_test in all_nf_tests if nf_test.test_type.value in args.types
-    ]
+    }
 
     # Go back n_parents directories, remove root from path and stringify
     # It's a bit much but might as well do all path manipulation in one place
     logging.info("Normalising test file paths")
-    normalised_nf_test_path = list(
-        {
-            str(
-                nf_test.get_parents(args.n_parents)
-                .resolve()
-                .relative_to(root_path.resolve())
-            )
-            for nf_test in only_selected_nf_tests
-        }
-    )
+    normalised_nf_test_path = {
+        str(
+            nf_test.get_parents(args.n_parents)
+            .resolve()
+            .relative_to(root_path.resolve())
+        )
+        for nf_test in only_selected_nf_tests
+    }
 
     # Print to string for outputs
     logging.debug("Creating output string...")
-    output_string = json.dumps(normalised_nf_test_path)
+    output_string = json.dumps(list(normalised_nf_test_path))
 
     if "GITHUB_OUTPUT" in os.environ:
         with open(os.environ["GITHUB_OUTPUT"], "a") as f: